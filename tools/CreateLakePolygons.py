@@ -21,92 +21,232 @@
 #
 #---------------------------------------------------------------
 
-# import libraries, set overwrite
+# import libraries
 import arcpy
 import os
+import sys
 import csv
 import re
-
-arcpy.env.overwriteOutput = True
-
-# === Parameters ===
-input_gdb = arcpy.GetParameterAsText(0)  # GDB containing classified rasters
-csv_file = arcpy.GetParameterAsText(1)   # CSV with classified_raster,water_class
-coastline = arcpy.GetParameterAsText(2)  # Coastline polygon
-area_threshold = float(arcpy.GetParameterAsText(3))  # e.g., 200
-output_gdb = arcpy.GetParameterAsText(4)  # GDB to store output lake polygons
+import shutil
+import tempfile
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+from scipy import ndimage
+
+# name of the coastline feature layer each worker creates once and reuses for every raster
+coastline_lyr = "coastline_lyr"
+
+# each worker's own file GDB, set by init_worker; holds its scratch data and finished lake polygons
+worker_gdb = None
+
+# tool dialog environment settings passed on to the workers
+env_settings = ["outputCoordinateSystem", "geographicTransformations", "extent", "snapRaster", "cellSize", "mask",
+                "XYTolerance", "XYResolution", "resamplingMethod", "compression", "pyramid", "rasterStatistics",
+                "tileSize", "nodata", "parallelProcessingFactor"]
 
 # define function to create output name in format "state_location_year_Lakes" from classified_raster name
 def raster_to_lake_name(raster_name):
     base = raster_name.rsplit("_", 1)[0]  # strip "_6class", "_8class", etc. from name
     return f"{base}_Lakes"
 
-# === Set environment ===
-arcpy.env.workspace = input_gdb
-arcpy.env.scratchWorkspace = arcpy.env.scratchGDB
-
-# === Read the CSV and process each raster ===
-with open(csv_file, newline="") as csvfile:
-    reader = list(csv.DictReader(csvfile))
-    total = len(reader)
-
-    for idx, row in enumerate(reader, start=1):
-        raster_name = row["classified_raster"]
-        water_class = row["water_class"]
-
-        # Skip if water class is blank
-        if not water_class.strip():
-            arcpy.AddWarning(f"Skipping {raster_name}: No water_class value specified.")
+Paths = namedtuple("Paths", "raster window polygons simplified")
+
+# define function to build all dataset paths for one classified raster in one place
+def make_paths(raster_name, input_gdb):
+    base = raster_name.split(".", 1)[0]  # GDB rasters have no extension; strips one from file rasters
+    return Paths(raster=os.path.join(input_gdb, raster_name),
+                 window=f"memory/{base}_window",  # in-memory intermediates
+                 polygons=f"memory/{base}_poly",
+                 simplified=f"memory/{base}_simp")
+
+# define function to convert a numpy array back to a raster aligned with the reference raster
+def array_to_raster(array, ref_raster, value_to_nodata=None):
+    lower_left = arcpy.Point(ref_raster.extent.XMin, ref_raster.extent.YMin)
+    out_raster = arcpy.NumPyArrayToRaster(array, lower_left, ref_raster.meanCellWidth, ref_raster.meanCellHeight,
+                                          value_to_nodata)
+    arcpy.management.DefineProjection(out_raster, ref_raster.spatialReference)  # numpy arrays carry no spatial reference
+    return out_raster
+
+# define class to hold one progress message per raster and send them to ArcGIS Pro every k rasters
+class MessageBuffer:
+    def __init__(self, k=10):
+        self.buf = []
+        self.k = k
+
+    def log(self, message):
+        self.buf.append(message)
+        if len(self.buf) >= self.k:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            arcpy.AddMessage("\n".join(self.buf))
+            self.buf.clear()
+
+# define function to capture the tool dialog environment settings in a form that can be sent to workers
+def capture_env():
+    settings = {}
+    for name in env_settings:
+        value = getattr(arcpy.env, name)
+        if value is None:
             continue
-
-        water_class = int(water_class)
-        output_name = raster_to_lake_name(raster_name)
-
-        full_raster_path = os.path.join(input_gdb, raster_name)
-        base_name = os.path.splitext(raster_name)[0]
-
-        # === In-memory names ===
-        reclass = f"in_memory/{base_name}_reclass"
-        majority = f"in_memory/{base_name}_majority"
-        filled = f"in_memory/{base_name}_filled"
-        lake_raster = f"in_memory/{base_name}_finalRC"
-        polygons = f"in_memory/{base_name}_poly"
-        clipped_polygons = f"in_memory/{base_name}_clipped"
-
-        arcpy.AddMessage(f"Processing {idx} of {total}: {raster_name}")
-
-        # 1. Reclassify water vs non-water
-        class_values = set()
-        with arcpy.da.SearchCursor(full_raster_path, ["Value"]) as cursor:
-            for row in cursor:
-                class_values.add(row[0])
-        non_water = [val for val in class_values if val != water_class]
-        remap = [[water_class, 1]] + [[val, 0] for val in non_water]
-        reclass = arcpy.sa.Reclassify(full_raster_path, "Value", arcpy.sa.RemapValue(remap))
-
-        # 2. Majority Filter
-        majority = arcpy.sa.MajorityFilter(reclass, "EIGHT", "HALF")
-
-        # 3. Fill
-        filled = arcpy.sa.Fill(arcpy.sa.Raster(majority))
-
-        # 4. Final reclass to remove 0s
-        lake_raster = arcpy.sa.Reclassify(filled, "Value", arcpy.sa.RemapValue([[0, "NODATA"], [1, 1]]))
-
-        # 5. Raster to Polygon
-        polygons = arcpy.conversion.RasterToPolygon(lake_raster, polygons, "SIMPLIFY", "Value")
-
-        # 6. Clip to coastline
-        arcpy.analysis.Clip(polygons, coastline, clipped_polygons)
-
-        # 7. Area filter (add area field first)
-        arcpy.management.MakeFeatureLayer(clipped_polygons, "temp_lyr")
-        arcpy.management.AddField("temp_lyr", "poly_area", "DOUBLE")
-        arcpy.management.CalculateGeometryAttributes("temp_lyr", [["poly_area", "AREA_GEODESIC"]], area_unit="SQUARE_METERS")
-        arcpy.management.SelectLayerByAttribute("temp_lyr", "NEW_SELECTION", f"poly_area > {area_threshold}")
-
-        # 8. Save output
-        final_output = os.path.join(output_gdb, arcpy.ValidateTableName(output_name, output_gdb))
-        arcpy.management.CopyFeatures("temp_lyr", final_output)
-
-        arcpy.AddMessage(f"--> Saved: {output_name}")
\ No newline at end of file
+        if isinstance(value, arcpy.SpatialReference):
+            value = value.exportToString()
+        elif isinstance(value, arcpy.Extent):
+            sr = value.spatialReference.exportToString() if value.spatialReference else None
+            value = (value.XMin, value.YMin, value.XMax, value.YMax, sr)
+        else:
+            value = str(value)
+        settings[name] = value
+    return settings
+
+# define function to apply settings from capture_env() in a worker, which starts with default arcpy.env values
+def apply_env(settings):
+    for name, value in settings.items():
+        if name == "extent" and isinstance(value, tuple):
+            *coords, sr_string = value
+            sr = None
+            if sr_string:
+                sr = arcpy.SpatialReference()
+                sr.loadFromString(sr_string)
+            value = arcpy.Extent(*coords, spatial_reference=sr)
+        setattr(arcpy.env, name, value)
+
+# define function to prepare a worker process (environment, scratch GDB, coastline layer)
+def init_worker(input_gdb, coastline, scratch_folder, env):
+    global worker_gdb
+    apply_env(env)
+    arcpy.env.overwriteOutput = True
+    arcpy.env.workspace = input_gdb
+    scratch_gdb = f"worker_{os.getpid()}.gdb"  # own GDB, so workers never write to the same one
+    arcpy.management.CreateFileGDB(scratch_folder, scratch_gdb)
+    worker_gdb = os.path.join(scratch_folder, scratch_gdb)
+    arcpy.env.scratchWorkspace = worker_gdb
+    arcpy.management.MakeFeatureLayer(coastline, coastline_lyr)
+
+# define function to create lake polygons for one classified raster
+def process_one(task, input_gdb, area_threshold, simplify_tolerance):
+    raster_name, water_class, final_output = task
+
+    paths = make_paths(raster_name, input_gdb)
+
+    # 1. Clip raster to coastline first so later steps only touch pixels inside it
+    # (cells outside the coastline become NoData and are treated as non-water below)
+    arcpy.management.Clip(paths.raster, "#", paths.window, coastline_lyr, "NoData", "ClippingGeometry")
+
+    # 2. Reclassify water (1) vs non-water (0) in a single pass over the pixels
+    ref_raster = arcpy.Raster(paths.window)
+    arr = arcpy.RasterToNumPyArray(ref_raster, nodata_to_value=0)
+    mask = (arr == water_class).astype(np.uint8)
+
+    # 3. Majority filter (on a 0/1 mask the 3x3 median approximates MajorityFilter "EIGHT", "HALF":
+    # a cell flips when five or more of its eight neighbours disagree with it, but there is no
+    # contiguity rule, and edge cells count reflected neighbours instead of using fewer)
+    majority = ndimage.median_filter(mask, size=3)
+
+    # 4. Fill enclosed non-water holes (8-connected background, like the D8 flow used by Fill)
+    filled = ndimage.binary_fill_holes(majority, structure=np.ones((3, 3))).astype(np.uint8)
+
+    # 5. Drop water bodies far too small to pass the area filter so they are never polygonized
+    # (projected rasters only, where cell size converts to square meters; the 10% margin leaves
+    # borderline bodies to the geodesic area filter below, which still has the final say)
+    sr = ref_raster.spatialReference
+    if sr.type == "Projected":
+        cell_area = ref_raster.meanCellWidth * ref_raster.meanCellHeight * sr.metersPerUnit ** 2
+        labels, _ = ndimage.label(filled, structure=np.ones((3, 3)))  # 8-connected, errs towards keeping
+        keep = np.bincount(labels.ravel()) * cell_area >= 0.9 * area_threshold
+        keep[0] = False  # label 0 is the non-water background
+        filled = keep[labels].astype(np.uint8)
+
+    # 6. Back to a raster with 0s as NoData
+    lake_raster = array_to_raster(filled, ref_raster, value_to_nodata=0)
+
+    # 7. Raster to Polygon (left unsimplified when a simplify tolerance is given; see step 8)
+    simplify = "NO_SIMPLIFY" if simplify_tolerance else "SIMPLIFY"
+    arcpy.conversion.RasterToPolygon(lake_raster, paths.polygons, simplify, "Value")
+    lakes = paths.polygons
+
+    # 8. Optional: simplify all polygons together with a user-specified tolerance
+    if simplify_tolerance:
+        arcpy.cartography.SimplifyPolygon(paths.polygons, paths.simplified, "POINT_REMOVE", simplify_tolerance,
+                                          collapsed_point_option="NO_KEEP")
+        arcpy.management.DeleteField(paths.simplified, ["InPoly_FID", "MaxSimpTol", "MinSimpTol"])  # keep output fields unchanged
+        lakes = paths.simplified
+
+    # 9. Calculate area (the poly_area field is added if it does not exist)
+    arcpy.management.CalculateGeometryAttributes(lakes, [["poly_area", "AREA_GEODESIC"]], area_unit="SQUARE_METERS")
+
+    # 10. Area filter, saved to this worker's GDB; the main process copies it to the output GDB
+    staged_output = os.path.join(worker_gdb, os.path.basename(final_output))
+    arcpy.analysis.Select(lakes, staged_output, f"poly_area > {area_threshold}")
+
+    arcpy.management.Delete("memory")  # clear intermediates
+
+    return staged_output
+
+
+if __name__ == "__main__":
+    arcpy.env.overwriteOutput = True
+
+    # === Parameters ===
+    input_gdb = arcpy.GetParameterAsText(0)  # GDB containing classified rasters
+    csv_file = arcpy.GetParameterAsText(1)   # CSV with classified_raster,water_class
+    coastline = arcpy.GetParameterAsText(2)  # Coastline polygon
+    area_threshold = float(arcpy.GetParameterAsText(3))  # e.g., 200
+    output_gdb = arcpy.GetParameterAsText(4)  # GDB to store output lake polygons
+    max_workers = arcpy.GetParameterAsText(5)  # Optional; rasters processed at once, blank = one per core
+    max_workers = max(1, min(int(max_workers), 61)) if max_workers else None  # 1 to 61 (Windows limit)
+    simplify_tolerance = arcpy.GetParameterAsText(6)  # Optional; e.g. "30 Meters", blank = simplify in RasterToPolygon
+
+    # === Stream the CSV and collect rasters to process ===
+    # output paths are resolved once here, so workers never query the output GDB for valid names
+    final_paths = {}
+    tasks = {}  # keyed by output path; rows writing the same output would run at once in the pool
+    with open(csv_file, newline="") as csvfile:
+        for row in csv.DictReader(csvfile):
+            raster_name = row["classified_raster"]
+            water_class = row["water_class"]
+
+            # Skip if water class is blank
+            if not water_class.strip():
+                arcpy.AddWarning(f"Skipping {raster_name}: No water_class value specified.")
+                continue
+
+            if raster_name not in final_paths:
+                output_name = raster_to_lake_name(raster_name)
+                final_paths[raster_name] = os.path.join(output_gdb, arcpy.ValidateTableName(output_name, output_gdb))
+
+            # keep only the last row for each output (run in order, the last row would win)
+            final_output = final_paths[raster_name]
+            if final_output in tasks:
+                arcpy.AddWarning(f"Skipping earlier row for {tasks.pop(final_output)[0]}: a later row for "
+                                 f"{raster_name} writes the same output {os.path.basename(final_output)}.")
+            tasks[final_output] = (raster_name, int(water_class), final_output)
+
+    tasks = list(tasks.values())
+    total = len(tasks)
+
+    # === Process rasters in parallel ===
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))  # Pro's python, not ArcGISPro.exe
+    worker = partial(process_one, input_gdb=input_gdb, area_threshold=area_threshold,
+                     simplify_tolerance=simplify_tolerance)
+
+    messages = MessageBuffer()
+    scratch_folder = tempfile.mkdtemp(prefix="CreateLakePolygons_", dir=arcpy.env.scratchFolder)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                 initargs=(input_gdb, coastline, scratch_folder, capture_env())) as ex:
+            for idx, (task, staged_output) in enumerate(zip(tasks, ex.map(worker, tasks)), start=1):
+                raster_name, _, final_output = task
+
+                # 11. Save output; only the main process writes to the output GDB
+                arcpy.management.CopyFeatures(staged_output, final_output)
+                arcpy.management.Delete(staged_output)
+
+                messages.log(f"Processed {idx} of {total}: {raster_name}\n--> Saved: {os.path.basename(final_output)}")
+    finally:
+        messages.flush()
+        shutil.rmtree(scratch_folder, ignore_errors=True)
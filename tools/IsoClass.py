@@ -18,7 +18,8 @@
 # 
 # Notes: Not all output files will have 6 classes; this depends on the color scheme of the input 
 # topographic maps. Adjust the number of classes, minimum class size, and sample interval as
-# needed for your study area.
+# needed for your study area. Rasters already listed in the "classified_rasters" csv file are
+# skipped, so an interrupted run can simply be restarted.
 #
 # Author: Dr. Alia Lesnek
 # School of Earth and Environmental Sciences, Queens College
@@ -28,17 +29,30 @@
 #---------------------------------------------------------------
 
 # # import libraries
-import re
 import arcpy
 import os
+import sys
 import csv
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# each worker's own file GDB, set by init_worker; holds unsaved and finished ISO results
+worker_gdb = None
+
+# environment settings from the tool dialog that the workers also use
+env_settings = ["outputCoordinateSystem", "geographicTransformations", "extent", "snapRaster", "cellSize", "mask",
+                "XYTolerance", "XYResolution", "resamplingMethod", "compression", "pyramid", "rasterStatistics",
+                "tileSize", "nodata", "parallelProcessingFactor"]
 
 # create a function to rename rasters with location_year
 def extract_location_year(raster_name):
     parts = raster_name.split("_")
         
-    # look for year
-    year = next((p for p in parts if re.fullmatch(r"\d{4}", p)), "unknown")
+    # look for year (four digits; isdecimal matches the same characters as regex \d)
+    year = next((p for p in parts if len(p) == 4 and p.isdecimal()), "unknown")
     
     # find index of year and extract location
     try:
@@ -51,54 +65,162 @@ def extract_location_year(raster_name):
     return f"{location}_{year}"
     
     
-# set parameters in tool
-input_gdb = arcpy.GetParameterAsText(0) # geodatabase location
-cell_size = arcpy.GetParameterAsText(1) # for resampled raster
-num_classes = int(arcpy.GetParameterAsText(2)) # number of classes for ISO cluster unsup. classification
-min_size = int(arcpy.GetParameterAsText(3)) # minimum class size; 20 is default
-sample_interval = int(arcpy.GetParameterAsText(4)) # sampling interval; 10 is default
-output_gdb = arcpy.GetParameterAsText(5) # optional; can be same as input
-project_folder = arcpy.GetParameterAsText(6) # choose location where raster names and water class will be saved
-
-# set workspace location and parameters
-arcpy.env.workspace = input_gdb
-arcpy.env.overwriteOutput = True
-
-# create csv for tracking classified outputs and writing raster names
-csv_path = os.path.join(project_folder, "classified_rasters.csv")
-if not os.path.exists(csv_path):
-    with open(csv_path, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["classified_raster", "water_class"])
-
-# get all rasters in geodatabase
-rasters = arcpy.ListRasters()
-total = len(rasters)
-
-# loop through resample and classification for all rasters in gdb, save to new file
-for idx, raster in enumerate(rasters, start = 1):
+# create a class to buffer messages, one entry per raster, flushed every k rasters
+class MessageBuffer:
+    def __init__(self, k=10):
+        self.buf = []
+        self.k = k
+
+    def log(self, message):
+        self.buf.append(message)
+        if len(self.buf) >= self.k:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            arcpy.AddMessage("\n".join(self.buf))
+            self.buf.clear()
+
+# create a function to read the environment settings chosen in the tool dialog as picklable values
+def capture_env():
+    settings = {}
+    for name in env_settings:
+        value = getattr(arcpy.env, name)
+        if value is None:
+            continue
+        if isinstance(value, arcpy.SpatialReference):
+            value = value.exportToString()
+        elif isinstance(value, arcpy.Extent):
+            sr = value.spatialReference.exportToString() if value.spatialReference else None
+            value = (value.XMin, value.YMin, value.XMax, value.YMax, sr)
+        else:
+            value = str(value)
+        settings[name] = value
+    return settings
+
+# create a function to restore those settings in a worker, since workers start with default settings
+def apply_env(settings):
+    for name, value in settings.items():
+        if name == "extent" and isinstance(value, tuple):
+            *coords, sr_string = value
+            sr = None
+            if sr_string:
+                sr = arcpy.SpatialReference()
+                sr.loadFromString(sr_string)
+            value = arcpy.Extent(*coords, spatial_reference=sr)
+        setattr(arcpy.env, name, value)
+
+# create a function to check out Spatial Analyst and set the environment in each worker
+def init_worker(input_gdb, scratch_folder, env):
+    global worker_gdb
+    apply_env(env)
+    arcpy.CheckOutExtension("Spatial")
+    arcpy.env.workspace = input_gdb
+    arcpy.env.overwriteOutput = True
+    scratch_gdb = f"worker_{os.getpid()}.gdb"
+    arcpy.management.CreateFileGDB(scratch_folder, scratch_gdb)
+    worker_gdb = os.path.join(scratch_folder, scratch_gdb)
+    arcpy.env.scratchWorkspace = worker_gdb
+
+# create a function to resample and classify one raster
+def process_one(raster, cell_size, num_classes, min_size, sample_interval):
     short_name = extract_location_year(raster)
 
     resampled_name = f"{short_name}_{cell_size}m"
     iso_output_name = f"{short_name}_{num_classes}class"
     
-    resampled_path = f"in_memory/{resampled_name}" # temporary file
-    iso_output_path = os.path.join(output_gdb, iso_output_name) # saved permanently
+    resampled_path = f"memory/{resampled_name}" # temporary file
+    staged_path = os.path.join(worker_gdb, iso_output_name) # copied to output gdb by the main process
 
-    arcpy.AddMessage(f"Processing {idx} of {total}: {raster}")
-    
     # RESAMPLE
     arcpy.management.Resample(raster, resampled_path, cell_size, "NEAREST")
     
-    arcpy.AddMessage(f"--> Resampled raster to {cell_size} meters: {resampled_name}")
-    
     # ISO CLUSTER UNSUPERVISED CLASSIFICATION
     iso_result = arcpy.sa.IsoClusterUnsupervisedClassification(resampled_path, num_classes, min_size, sample_interval)
-    iso_result.save(iso_output_path)
+    iso_result.save(staged_path)
+
+    arcpy.management.Delete("memory") # clear resampled raster
+
+    return staged_path
 
-    # write output raster name to csv
-    with open(csv_path, "a", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow([iso_output_name, ""])
 
-    arcpy.AddMessage(f"--> Saved classified raster: {iso_output_name}")
+if __name__ == "__main__":
+    # set parameters in tool
+    input_gdb = arcpy.GetParameterAsText(0) # geodatabase location
+    cell_size = arcpy.GetParameterAsText(1) # for resampled raster
+    num_classes = int(arcpy.GetParameterAsText(2)) # number of classes for ISO cluster unsup. classification
+    min_size = int(arcpy.GetParameterAsText(3)) # minimum class size; 20 is default
+    sample_interval = int(arcpy.GetParameterAsText(4)) # sampling interval; 10 is default
+    output_gdb = arcpy.GetParameterAsText(5) # optional; can be same as input
+    project_folder = arcpy.GetParameterAsText(6) # choose location where raster names and water class will be saved
+    max_workers = arcpy.GetParameterAsText(7) # optional; rasters processed at once, blank = one per core
+    max_workers = max(1, min(int(max_workers), 61)) if max_workers else None # 1 to 61 (Windows limit)
+    build_pyramids = arcpy.GetParameterAsText(8).lower() == "true" # optional; off by default, writes to input gdb
+
+    # set workspace location and parameters
+    arcpy.env.workspace = input_gdb
+    arcpy.env.overwriteOutput = True
+
+    # create csv for tracking classified outputs and writing raster names
+    csv_path = os.path.join(project_folder, "classified_rasters.csv")
+    if not os.path.exists(csv_path):
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["classified_raster", "water_class"])
+
+    # read rasters already classified by earlier runs, so an interrupted run picks up where it stopped
+    with open(csv_path, newline="") as f:
+        done = {row["classified_raster"] for row in csv.DictReader(f)}
+
+    # get all rasters in geodatabase that have not been classified yet; rasters that share an output
+    # name would be saved at the same time in the pool, so keep only the last, as a serial run would
+    pending = {}
+    skipped = 0
+    for raster in arcpy.ListRasters():
+        iso_output_name = f"{extract_location_year(raster)}_{num_classes}class"
+        if iso_output_name in done:
+            skipped += 1
+            continue
+        if iso_output_name in pending:
+            arcpy.AddWarning(f"Skipping {pending.pop(iso_output_name)}: {raster} is saved to the same "
+                             f"classified raster {iso_output_name}.")
+        pending[iso_output_name] = raster
+
+    rasters = list(pending.values())
+    total = len(rasters)
+
+    if skipped:
+        arcpy.AddMessage(f"Skipping {skipped} rasters already listed in classified_rasters.csv")
+
+    # optionally build pyramids so Resample can read the level closest to cell_size; done here, one
+    # raster at a time, so only one process writes to the input gdb (existing pyramids are kept)
+    if build_pyramids:
+        for raster in rasters:
+            arcpy.management.BuildPyramids(raster, skip_existing="SKIP_EXISTING")
+
+    # resample and classify rasters in parallel
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe")) # run workers with Pro's python
+    worker = partial(process_one, cell_size=cell_size, num_classes=num_classes, min_size=min_size,
+                     sample_interval=sample_interval)
+
+    messages = MessageBuffer()
+    results = []
+    scratch_folder = tempfile.mkdtemp(prefix="IsoClass_", dir=arcpy.env.scratchFolder)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                 initargs=(input_gdb, scratch_folder, capture_env())) as ex:
+            for idx, (raster, staged_path) in enumerate(zip(rasters, ex.map(worker, rasters)), start = 1):
+                # save classified raster; only the main process writes to the output gdb
+                iso_output_name = os.path.basename(staged_path)
+                arcpy.management.CopyRaster(staged_path, os.path.join(output_gdb, iso_output_name))
+                arcpy.management.Delete(staged_path)
+
+                results.append((iso_output_name, ""))
+                messages.log(f"Processed {idx} of {total}: {raster}\n--> Saved classified raster: {iso_output_name}")
+    finally:
+        # write output raster names to csv in one batch; only the main process touches the file,
+        # and rasters that finished before an error are still recorded for the next run
+        with open(csv_path, "a", newline="") as f:
+            csv.writer(f).writerows(results)
+        messages.flush()
+        shutil.rmtree(scratch_folder, ignore_errors=True)